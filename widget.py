@@ -1,8 +1,28 @@
-from collections import Counter
-from typing import Generator
+import hashlib
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import combinations_with_replacement
+from math import comb
+from operator import add, le
+from typing import Iterator, Optional
+
+import numpy as np
+from numba import float64, int32, int64, njit, types, uint64, void
+from numba.extending import overload
 
 
 Roll = tuple[int, ...]
+Counts = tuple[int, ...]
+WidgetTables = tuple[list[dict[Roll, float]], list[dict[Roll, list[Roll]]]]
+
+_YAHTZEE_NUM_DICE = 5
+_YAHTZEE_NUM_FACES = 6
+_YAHTZEE_SIZES_END = comb(_YAHTZEE_NUM_DICE - 1 + _YAHTZEE_NUM_FACES, _YAHTZEE_NUM_FACES)
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "yahtzee_optimize")
 
 
 class Widget:
@@ -15,18 +35,47 @@ class Widget:
         num_rolls: int = 3,
         keep_all_optimal: bool = False,
         use_dynamic_programming: bool = True,
+        use_cache: bool = True,
+        cache_dir: str = DEFAULT_CACHE_DIR,
     ):
         self.num_dice = num_dice
         self.num_faces = num_faces
         self.num_rolls = num_rolls
         self.keep_all_optimal = keep_all_optimal
         self.use_dynamic_programming = use_dynamic_programming
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+
+        self._build_multiset_index()
 
         self.roll_values = [{} for _ in range(self.num_rolls - 1)]
         self.roll_values.append(self._parse_roll_values(roll_values))
         self.optimal_moves = [{} for _ in range(self.num_rolls - 1)]
 
-        self._compute_strategy_and_values()
+        if not self.use_cache:
+            self._compute_strategy_and_values()
+        elif not self._load_from_cache():
+            self._compute_strategy_and_values()
+            self._save_to_cache()
+
+    def _build_multiset_index(self):
+        self.roll_by_id = []
+        self.size_start = []
+        for num_kept in range(self.num_dice + 1):
+            self.size_start.append(len(self.roll_by_id))
+            self.roll_by_id.extend(_all_rolls(num_kept, self.num_faces))
+        self.size_start.append(len(self.roll_by_id))
+
+        self.id_of = {roll: roll_id for roll_id, roll in enumerate(self.roll_by_id)}
+        self.size_of_id = np.array([len(roll) for roll in self.roll_by_id], dtype=np.int32)
+        self.counts_by_id = [to_counts(roll, self.num_faces) for roll in self.roll_by_id]
+        self.id_of_counts = {counts: roll_id for roll_id, counts in enumerate(self.counts_by_id)}
+
+        self.next_id = np.full((len(self.roll_by_id), self.num_faces + 1), -1, dtype=np.int32)
+        for roll_id in range(self.size_start[self.num_dice]):
+            counts = self.counts_by_id[roll_id]
+            for die in range(1, self.num_faces + 1):
+                self.next_id[roll_id, die] = self.id_of_counts[counts[:die - 1] + (counts[die - 1] + 1,) + counts[die:]]
 
     def _parse_roll_values(self, roll_values: dict[Roll, float]) -> dict[Roll, float]:
         parsed_roll_values = {}
@@ -37,104 +86,470 @@ class Widget:
                 raise ValueError(f"Inconsistent values for roll {roll}: {pre_existing_value} and {value}")
             parsed_roll_values[roll] = value
 
-        for roll in iter_possible_rolls(self.num_dice, self.num_faces):
-            if roll not in parsed_roll_values:
-                raise ValueError(f"Roll missing in input roll_values: {roll}")
+        missing_rolls = _all_roll_set(self.num_dice, self.num_faces).difference(parsed_roll_values)
+        if missing_rolls:
+            raise ValueError(f"Roll missing in input roll_values: {min(missing_rolls)}")
 
         return parsed_roll_values
 
+    def _cache_path(self) -> str:
+        key = hashlib.blake2b(pickle.dumps((
+            CACHE_VERSION,
+            sorted(self.roll_values[-1].items()),
+            self.num_dice,
+            self.num_faces,
+            self.num_rolls,
+            self.keep_all_optimal,
+            self.use_dynamic_programming,
+        ))).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _load_from_cache(self) -> bool:
+        try:
+            with open(self._cache_path(), "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            return False
+
+        if not (
+            isinstance(cached, tuple)
+            and len(cached) == 2
+            and isinstance(cached[0], list)
+            and isinstance(cached[1], list)
+            and len(cached[0]) == self.num_rolls
+            and len(cached[1]) == self.num_rolls - 1
+        ):
+            return False
+
+        self.roll_values, self.optimal_moves = cached
+        return True
+
+    def _save_to_cache(self):
+        path = self._cache_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump((self.roll_values, self.optimal_moves), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
     def _compute_strategy_and_values(self):
+        values = self._final_values()
+        roll_scale = self.num_faces ** self.num_dice if values.dtype == np.int64 else 1
+        scale = 1
         for idx in range(self.num_rolls - 2, -1, -1):
-            self.roll_values[idx], self.optimal_moves[idx] = self._compute_strategy_one_roll(self.roll_values[idx + 1])
+            values, moves = self._compute_strategy_one_roll(values)
+            scale *= roll_scale
+            self.roll_values[idx] = self._values_to_dict(values, scale)
+            self.optimal_moves[idx] = self._moves_to_dict(moves)
 
-    def _compute_strategy_one_roll(self, next_roll_values: dict[Roll, float]) -> tuple[
-        dict[Roll, float], dict[Roll, list[Roll]]
-    ]:
+    def _final_values(self) -> np.ndarray:
+        values = np.zeros(len(self.roll_by_id), dtype=np.float64)
+        for roll, value in self.roll_values[-1].items():
+            if roll in self.id_of:
+                values[self.id_of[roll]] = value
+
+        # Integral values are kept exact in int64 by never dividing by num_faces: each roll multiplies them by
+        # num_faces ** num_dice (via size_scale) and _values_to_dict divides by the accumulated scale.  That is
+        # only done while the largest scaled value fits; anything else is averaged in float64 one die at a time.
+        is_exact = bool(np.all(np.isfinite(values)) and np.all(values == np.round(values)))
+        if is_exact:
+            max_value = max(1, int(np.abs(values).max()))
+            is_exact = max_value * self.num_faces ** (self.num_dice * max(1, self.num_rolls - 1)) < 2 ** 62
+
+        if not is_exact:
+            # The float64 kernels do not read size_scale.
+            self.size_scale = np.ones(len(self.roll_by_id), dtype=np.int64)
+            return values
+        self.size_scale = np.array([self.num_faces ** size for size in self.size_of_id.tolist()], dtype=np.int64)
+        return values.astype(np.int64)
+
+    def _values_to_dict(self, values: np.ndarray, scale: int) -> dict[Roll, float]:
+        start, end = self.size_start[self.num_dice], self.size_start[self.num_dice + 1]
+        return dict(zip(self.roll_by_id[start:end], [value / scale for value in values[start:end].tolist()]))
+
+    def _moves_to_dict(self, moves: np.ndarray) -> dict[Roll, list[Roll]]:
+        start, end = self.size_start[self.num_dice], self.size_start[self.num_dice + 1]
+        rolls = self.roll_by_id[start:end]
+        if moves.ndim == 1:
+            return {roll: [self.roll_by_id[move_id]] for roll, move_id in zip(rolls, moves[start:end].tolist())}
+
+        optimal_moves = {roll: [] for roll in rolls}
+        for row, move_id in _unpack_move_bits(moves[start:end]):
+            optimal_moves[rolls[row]].append(self.roll_by_id[move_id])
+        return optimal_moves
+
+    def _compute_strategy_one_roll(self, next_roll_values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if self.use_dynamic_programming:
+            return self._compute_strategy_one_roll_dp(next_roll_values)
         values_given_kept = self._compute_values_given_kept(next_roll_values)
-        return self._compute_from_conditional_values(values_given_kept)
+        return self._compute_from_cond(values_given_kept)
 
-    def _compute_values_given_kept(self, next_roll_values: dict[Roll, float]) -> dict[Roll, float]:
+    def _compute_values_given_kept(self, next_roll_values: np.ndarray) -> np.ndarray:
         values_given_kept = next_roll_values.copy()
+        _values_given_kept_kernel(
+            values_given_kept, self.next_id, self.size_scale, self.size_start[self.num_dice], self.num_faces,
+        )
+        return values_given_kept
+
+    def _compute_strategy_one_roll_dp(self, next_roll_values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        roll_values = next_roll_values.copy()
+        num_ids = len(self.roll_by_id)
+
+        is_yahtzee_shape = (self.num_dice, self.num_faces) == (_YAHTZEE_NUM_DICE, _YAHTZEE_NUM_FACES)
+
+        if self.keep_all_optimal:
+            all_ids = np.arange(num_ids)
+            optimal_moves = _pack_move_bits(all_ids, all_ids, num_ids)
+            if is_yahtzee_shape:
+                _dp_all_optimal_kernel_5x6(roll_values, optimal_moves, self.next_id, self.size_scale)
+            else:
+                _dp_all_optimal_kernel(
+                    roll_values, optimal_moves, self.next_id, self.size_scale, self.size_start[self.num_dice],
+                    self.num_faces,
+                )
+            return roll_values, optimal_moves
+
+        best_move = np.arange(num_ids, dtype=np.int32)
+        if is_yahtzee_shape:
+            _dp_kernel_5x6(roll_values, best_move, self.next_id, self.size_scale)
+        else:
+            _dp_kernel(
+                roll_values, best_move, self.next_id, self.size_scale, self.size_start[self.num_dice],
+                self.num_faces,
+            )
+        return roll_values, best_move
+
+    def _compute_from_cond(self, values_given_kept: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        roll_values = values_given_kept.copy()
+        optimal_moves = [[roll_id] for roll_id in range(len(self.roll_by_id))]
+
         for num_kept in range(self.num_dice - 1, -1, -1):
-            for kept in iter_possible_rolls(num_kept, self.num_faces):
-                values_given_kept[kept] = sum(
-                    values_given_kept[tuple(sorted(kept + (i,)))] for i in range(1, self.num_faces + 1)
-                ) / self.num_faces
+            for kept_id in range(self.size_start[num_kept], self.size_start[num_kept + 1]):
+                kept_counts = self.counts_by_id[kept_id]
+                value = values_given_kept[kept_id]
+                num_other = self.num_dice - num_kept
+                for other_id in range(self.size_start[num_other], self.size_start[num_other + 1]):
+                    other_counts = self.counts_by_id[other_id]
+                    roll_id = self.id_of_counts[tuple(map(add, kept_counts, other_counts))]
+                    if value > roll_values[roll_id]:
+                        roll_values[roll_id] = value
+                        optimal_moves[roll_id] = [kept_id]
+                    elif self.keep_all_optimal and value == roll_values[roll_id]:
+                        optimal_moves[roll_id].append(kept_id)
+
+        if not self.keep_all_optimal:
+            return roll_values, np.array([moves[0] for moves in optimal_moves], dtype=np.int32)
+
+        roll_ids = [roll_id for roll_id, moves in enumerate(optimal_moves) for _ in moves]
+        move_ids = [kept_id for moves in optimal_moves for kept_id in moves]
+        return roll_values, _pack_move_bits(np.array(roll_ids), np.array(move_ids), len(self.roll_by_id))
+
+
+def build_widget_tables(roll_values: dict[Roll, float], **widget_kwargs) -> WidgetTables:
+    widget = Widget(roll_values, **widget_kwargs)
+    return widget.roll_values, widget.optimal_moves
+
+
+def build_all_widget_tables(
+    roll_values_list: list[dict[Roll, float]],
+    parallel: bool = False,
+    max_workers: Optional[int] = None,
+    **widget_kwargs,
+) -> list[WidgetTables]:
+    if not parallel:
+        return [build_widget_tables(roll_values, **widget_kwargs) for roll_values in roll_values_list]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(build_widget_tables, **widget_kwargs), roll_values_list))
+
+
+def _values_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces):
+    raise NotImplementedError("only callable from the numba kernels below")
+
+
+@overload(_values_given_kept_body, inline="always")
+def _overload_values_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces):
+    if isinstance(vals.dtype, types.Integer):
+        def sum_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces):
+            for kept_id in range(sizes_end - 1, -1, -1):
+                successors = next_id[kept_id]
+                total = vals[successors[1]]
+                for die in range(2, num_faces + 1):
+                    total += vals[successors[die]]
+                vals[kept_id] = total
+            for roll_id in range(len(vals)):
+                vals[roll_id] *= size_scale[roll_id]
+        return sum_given_kept_body
+
+    def mean_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces):
+        for kept_id in range(sizes_end - 1, -1, -1):
+            successors = next_id[kept_id]
+            total = vals[successors[1]]
+            for die in range(2, num_faces + 1):
+                total += vals[successors[die]]
+            vals[kept_id] = total / num_faces
+    return mean_given_kept_body
+
+
+@njit(inline="always")
+def _dp_body(vals, best_move, next_id, sizes_end, num_faces):
+    for prev_id in range(sizes_end):
+        value = vals[prev_id]
+        move = best_move[prev_id]
+        successors = next_id[prev_id]
+        for die in range(1, num_faces + 1):
+            kept_id = successors[die]
+            improves = value > vals[kept_id]
+            vals[kept_id] = value if improves else vals[kept_id]
+            best_move[kept_id] = move if improves else best_move[kept_id]
 
-        return values_given_kept
 
-    def _compute_from_conditional_values(self, values_given_kept: dict[Roll, float]) -> tuple[
-        dict[Roll, float], dict[Roll, list[Roll]]
+@njit(inline="always")
+def _dp_all_optimal_body(vals, moves, next_id, sizes_end, num_faces):
+    num_words = moves.shape[1]
+    for prev_id in range(sizes_end):
+        value = vals[prev_id]
+        for die in range(1, num_faces + 1):
+            kept_id = next_id[prev_id, die]
+            if value > vals[kept_id]:
+                vals[kept_id] = value
+                for word in range(num_words):
+                    moves[kept_id, word] = moves[prev_id, word]
+            elif value == vals[kept_id]:
+                for word in range(num_words):
+                    moves[kept_id, word] |= moves[prev_id, word]
+
+
+@njit([
+    void(float64[::1], int32[:, ::1], int64[::1], int32, int32),
+    void(int64[::1], int32[:, ::1], int64[::1], int32, int32),
+], cache=True, nogil=True)
+def _values_given_kept_kernel(vals, next_id, size_scale, sizes_end, num_faces):
+    _values_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces)
+
+
+@njit([
+    void(float64[::1], int32[::1], int32[:, ::1], int64[::1], int32, int32),
+    void(int64[::1], int32[::1], int32[:, ::1], int64[::1], int32, int32),
+], cache=True, nogil=True)
+def _dp_kernel(vals, best_move, next_id, size_scale, sizes_end, num_faces):
+    _values_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces)
+    _dp_body(vals, best_move, next_id, sizes_end, num_faces)
+
+
+@njit([
+    void(float64[::1], uint64[:, ::1], int32[:, ::1], int64[::1], int32, int32),
+    void(int64[::1], uint64[:, ::1], int32[:, ::1], int64[::1], int32, int32),
+], cache=True, nogil=True)
+def _dp_all_optimal_kernel(vals, moves, next_id, size_scale, sizes_end, num_faces):
+    _values_given_kept_body(vals, next_id, size_scale, sizes_end, num_faces)
+    _dp_all_optimal_body(vals, moves, next_id, sizes_end, num_faces)
+
+
+@njit([
+    void(float64[::1], int32[::1], int32[:, ::1], int64[::1]),
+    void(int64[::1], int32[::1], int32[:, ::1], int64[::1]),
+], cache=True, nogil=True)
+def _dp_kernel_5x6(vals, best_move, next_id, size_scale):
+    _values_given_kept_body(vals, next_id, size_scale, _YAHTZEE_SIZES_END, _YAHTZEE_NUM_FACES)
+    _dp_body(vals, best_move, next_id, _YAHTZEE_SIZES_END, _YAHTZEE_NUM_FACES)
+
+
+@njit([
+    void(float64[::1], uint64[:, ::1], int32[:, ::1], int64[::1]),
+    void(int64[::1], uint64[:, ::1], int32[:, ::1], int64[::1]),
+], cache=True, nogil=True)
+def _dp_all_optimal_kernel_5x6(vals, moves, next_id, size_scale):
+    _values_given_kept_body(vals, next_id, size_scale, _YAHTZEE_SIZES_END, _YAHTZEE_NUM_FACES)
+    _dp_all_optimal_body(vals, moves, next_id, _YAHTZEE_SIZES_END, _YAHTZEE_NUM_FACES)
+
+
+def _pack_move_bits(roll_ids: np.ndarray, move_ids: np.ndarray, num_ids: int) -> np.ndarray:
+    bits = np.zeros((num_ids, (num_ids + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(
+        bits, (roll_ids, move_ids // 64), np.left_shift(np.uint64(1), (move_ids % 64).astype(np.uint64)),
+    )
+    return bits
+
+
+def _unpack_move_bits(bits: np.ndarray) -> Iterator[tuple[int, int]]:
+    rows, word_idxs = np.nonzero(bits)
+    for row, word_idx, word in zip(rows.tolist(), word_idxs.tolist(), bits[rows, word_idxs].tolist()):
+        while word:
+            low_bit = word & -word
+            yield row, 64 * word_idx + low_bit.bit_length() - 1
+            word ^= low_bit
+
+
+def iter_possible_rolls(num_dice: int, num_faces: int) -> Iterator[Roll]:
+    return combinations_with_replacement(range(1, num_faces + 1), num_dice)
+
+
+@lru_cache(maxsize=None)
+def _all_rolls(num_dice: int, num_faces: int) -> tuple[Roll, ...]:
+    return tuple(iter_possible_rolls(num_dice, num_faces))
+
+
+@lru_cache(maxsize=None)
+def _all_roll_set(num_dice: int, num_faces: int) -> frozenset[Roll]:
+    return frozenset(_all_rolls(num_dice, num_faces))
+
+
+def to_counts(roll: Roll, num_faces: int) -> Counts:
+    counts = [0] * num_faces
+    for face_value in roll:
+        counts[face_value - 1] += 1
+    return tuple(counts)
+
+
+def is_subroll(subroll: Roll, roll: Roll) -> bool:
+    if not subroll:
+        return True
+    lowest_face = min(subroll + roll)
+    num_buckets = max(subroll + roll) - lowest_face + 1
+    subroll_counts = [0] * num_buckets
+    roll_counts = [0] * num_buckets
+    for face_value in subroll:
+        subroll_counts[face_value - lowest_face] += 1
+    for face_value in roll:
+        roll_counts[face_value - lowest_face] += 1
+    return all(map(le, subroll_counts, roll_counts))
+
+
+if __name__ == "__main__":
+    import tempfile
+    from fractions import Fraction
+    from itertools import combinations, product
+
+    def exact_optimal_moves(
+        roll_values: dict[Roll, float], num_dice: int, num_faces: int, num_rolls: int,
+    ) -> list[dict[Roll, list[Roll]]]:
+        values = {roll: Fraction(value) for roll, value in roll_values.items()}
+        optimal_moves = []
+        for _ in range(num_rolls - 1):
+            values_given_kept = {}
+            for num_kept in range(num_dice + 1):
+                outcomes = list(product(range(1, num_faces + 1), repeat=num_dice - num_kept))
+                for kept in iter_possible_rolls(num_kept, num_faces):
+                    values_given_kept[kept] = sum(
+                        values[tuple(sorted(kept + outcome))] for outcome in outcomes
+                    ) / len(outcomes)
+
+            moves = {}
+            for roll in iter_possible_rolls(num_dice, num_faces):
+                keeps = {kept for num_kept in range(num_dice + 1) for kept in combinations(roll, num_kept)}
+                best_value = max(values_given_kept[kept] for kept in keeps)
+                values[roll] = best_value
+                moves[roll] = sorted(kept for kept in keeps if values_given_kept[kept] == best_value)
+            optimal_moves.insert(0, moves)
+
+        return optimal_moves
+
+    # Every reported keep must be a subroll of the roll, and every tied optimal keep must be reported.
+    for num_dice, num_faces, num_rolls, score in [
+        (5, 6, 3, lambda roll: float(roll[0] == roll[-1])),
+        (3, 4, 3, lambda roll: sum(roll) % 3),
+        (4, 3, 4, sum),
+        (2, 2, 3, lambda roll: roll.count(2)),
     ]:
-        if self.use_dynamic_programming:
-            return self._compute_from_cond_dp(values_given_kept)
-        return self._compute_from_cond(values_given_kept)
+        roll_values = {roll: score(roll) for roll in iter_possible_rolls(num_dice, num_faces)}
+        expected_moves = exact_optimal_moves(roll_values, num_dice, num_faces, num_rolls)
+        for use_dynamic_programming in (True, False):
+            widget = Widget(
+                roll_values, num_dice, num_faces, num_rolls,
+                keep_all_optimal=True, use_dynamic_programming=use_dynamic_programming, use_cache=False,
+            )
+            for idx in range(num_rolls - 1):
+                for roll, moves in widget.optimal_moves[idx].items():
+                    assert all(is_subroll(kept, roll) for kept in moves), (roll, moves)
+                    assert sorted(moves) == expected_moves[idx][roll], (roll, moves, expected_moves[idx][roll])
 
-    def _compute_from_cond_dp(self, values_given_kept: dict[Roll, float]) -> tuple[
-        dict[Roll, float], dict[Roll, list[Roll]]
+            widget = Widget(
+                roll_values, num_dice, num_faces, num_rolls,
+                use_dynamic_programming=use_dynamic_programming, use_cache=False,
+            )
+            for idx in range(num_rolls - 1):
+                for roll, moves in widget.optimal_moves[idx].items():
+                    assert len(moves) == 1 and moves[0] in expected_moves[idx][roll], (roll, moves)
+
+    # Tied keeps that rounding used to drop when each step divided by num_faces in floating point.
+    for num_dice, num_rolls, roll, expected in [
+        (3, 2, (1, 2, 3), [(), (1,), (2,), (3,)]),
+        (5, 3, (1, 1, 2, 4, 4), [(1, 1), (4, 4)]),
     ]:
-        roll_values = {(): values_given_kept[()]}
-        optimal_moves = {(): {()}}
-
-        for num_kept in range(1, self.num_dice + 1):
-            for kept in iter_possible_rolls(num_kept, self.num_faces):
-                roll_values[kept] = values_given_kept[kept]
-                optimal_moves[kept] = {kept}
-            for prev_kept in iter_possible_rolls(num_kept - 1, self.num_faces):
-                value = roll_values[prev_kept]
-                moves = optimal_moves[prev_kept]
-                for die in range(1, self.num_faces + 1):
-                    kept = tuple(sorted(prev_kept + (die,)))
-                    if value > roll_values[kept]:
-                        roll_values[kept] = value
-                        optimal_moves[kept] = moves
-                    elif self.keep_all_optimal and value == roll_values[kept]:
-                        optimal_moves[kept].update(moves)
-
-        roll_values = {roll: value for roll, value in roll_values.items() if len(roll) == self.num_dice}
-        optimal_moves = {roll: list(moves) for roll, moves in optimal_moves.items() if len(roll) == self.num_dice}
-
-        return roll_values, optimal_moves
-
-    def _compute_from_cond(self, values_given_kept: dict[Roll, float]) -> tuple[
-        dict[Roll, float], dict[Roll, list[Roll]]
+        roll_values = {r: float(r[0] == r[-1]) for r in iter_possible_rolls(num_dice, 6)}
+        for use_dynamic_programming in (True, False):
+            widget = Widget(
+                roll_values, num_dice, 6, num_rolls,
+                keep_all_optimal=True, use_dynamic_programming=use_dynamic_programming, use_cache=False,
+            )
+            assert sorted(widget.optimal_moves[0][roll]) == expected, (roll, widget.optimal_moves[0][roll])
+
+    # Shapes whose scale factors do not fit in int64 fall back to averaging in float64.
+    for num_dice, num_faces, score, roll, expected in [
+        (40, 3, sum, (3,) * 40, 120.0),
+        (40, 3, lambda roll: -sum(roll), (1,) * 40, -40.0),
+        (63, 2, sum, (2,) * 63, 126.0),
+        (63, 2, lambda roll: -sum(roll), (1,) * 63, -63.0),
     ]:
-        roll_values = {roll: values_given_kept[roll] for roll in iter_possible_rolls(self.num_dice, self.num_faces)}
-        optimal_moves = {roll: [roll] for roll in iter_possible_rolls(self.num_dice, self.num_faces)}
-        
-        for num_kept in range(self.num_dice - 1, -1, -1):
-            for kept in iter_possible_rolls(num_kept, self.num_faces):
-                value = values_given_kept[kept]
-                for other_dice in iter_possible_rolls(self.num_dice - num_kept, self.num_faces):
-                    roll = tuple(sorted(kept + other_dice))
-                    if value > roll_values[roll]:
-                        roll_values[roll] = value
-                        optimal_moves[roll] = [kept]
-                    elif self.keep_all_optimal and value == roll_values[roll]:
-                        optimal_moves[roll].append(kept)
-
-        return roll_values, optimal_moves
-
-
-def iter_possible_rolls(num_dice: int, num_faces: int) -> Generator[Roll, None, None]:
-    if num_dice == 0:
-        yield ()
-        return
-
-    roll = [1 for _ in range(num_dice)]
-    yield tuple(roll)
-    while any(face_value != num_faces for face_value in roll):
-        for idx_to_increment, face_value in reversed(list(enumerate(roll))):
-            if face_value != num_faces:
-                break
-        else:
-            assert False, "Logic error"
-        roll[idx_to_increment] = face_value + 1
-        for idx in range(idx_to_increment + 1, len(roll)):
-            roll[idx] = roll[idx_to_increment]
+        roll_values = {r: score(r) for r in iter_possible_rolls(num_dice, num_faces)}
+        value = Widget(roll_values, num_dice, num_faces, 2, use_cache=False).roll_values[0][roll]
+        assert value == expected, (num_dice, num_faces, value, expected)
 
-        yield tuple(roll)
+    roll_values = {roll: float(roll[0] == roll[-1]) for roll in iter_possible_rolls(5, 6)}
+    value = Widget(roll_values, 5, 6, 81, use_cache=False).roll_values[0][(1, 2, 3, 4, 6)]
+    assert 0.999 < value < 1.0, value
 
+    roll_values = {roll: 1e200 for roll in iter_possible_rolls(5, 6)}
+    value = Widget(roll_values, 5, 6, 30, use_cache=False).roll_values[0][(1, 2, 3, 4, 6)]
+    assert abs(value - 1e200) < 1e188, value
 
-def is_subroll(subroll: Roll, roll: Roll) -> bool:
-    return Counter(subroll) <= Counter(roll)
+    # Tables built in worker processes match the serial build.
+    roll_values_list = [
+        {roll: score(roll) for roll in iter_possible_rolls(5, 6)}
+        for score in (sum, lambda roll: float(roll[0] == roll[-1]), lambda roll: roll.count(6))
+    ]
+    serial_tables = build_all_widget_tables(roll_values_list, keep_all_optimal=True, use_cache=False)
+    parallel_tables = build_all_widget_tables(
+        roll_values_list, parallel=True, max_workers=2, keep_all_optimal=True, use_cache=False,
+    )
+    assert parallel_tables == serial_tables
+
+    # Cache hits return the stored tables; corrupt, wrongly shaped or unwritable caches fall back to computing.
+    roll_values = {roll: sum(roll) for roll in iter_possible_rolls(3, 4)}
+    expected = Widget(roll_values, 3, 4, 3, use_cache=False)
+    expected_tables = (expected.roll_values, expected.optimal_moves)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        widget = Widget(roll_values, 3, 4, 3, cache_dir=cache_dir)
+        assert (widget.roll_values, widget.optimal_moves) == expected_tables
+        cache_path = widget._cache_path()
+        assert os.path.exists(cache_path)
+
+        marked_tables = ([{(1, 1, 1): -1.0}] + expected.roll_values[1:], expected.optimal_moves)
+        with open(cache_path, "wb") as f:
+            pickle.dump(marked_tables, f)
+        widget = Widget(roll_values, 3, 4, 3, cache_dir=cache_dir)
+        assert (widget.roll_values, widget.optimal_moves) == marked_tables
+
+        for contents in (b"not a pickle", pickle.dumps(([], []))):
+            with open(cache_path, "wb") as f:
+                f.write(contents)
+            widget = Widget(roll_values, 3, 4, 3, cache_dir=cache_dir)
+            assert (widget.roll_values, widget.optimal_moves) == expected_tables
+            with open(cache_path, "rb") as f:
+                assert pickle.load(f) == expected_tables
+
+        not_a_dir = os.path.join(cache_dir, "not_a_dir")
+        open(not_a_dir, "w").close()
+        widget = Widget(roll_values, 3, 4, 3, cache_dir=not_a_dir)
+        assert (widget.roll_values, widget.optimal_moves) == expected_tables
+
+    print("All checks passed")
@@ -10,6 +10,7 @@ from numpy import *
 import sys
 from collections import Counter
 from math import factorial
+from bisect import bisect_right
 
 #-----------------------                                                        
 #Globals
@@ -131,12 +132,9 @@ class Widget:
         #-----------------------------------------------------
         if combo=='three of a kind' or combo=='three of a kind weighted':
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
-                #c.most_common(1)[0] gives an order pair:
-                #(most common number,its frequency)
-                #Thus c.most_common(1)[0][1] is the frequency
-                #of the most common number.
-                if c.most_common(1)[0][1]>=3:
+                #max_run(roll) is the frequency of the most
+                #common number, since roll is sorted.
+                if max_run(roll)>=3:
                     if combo=='three of a kind':
                         points_dict[roll]=1.
                     else:
@@ -146,12 +144,9 @@ class Widget:
             
         elif combo=='four of a kind' or combo=='four of a kind weighted':
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
-                #c.most_common(1)[0] gives an order pair:
-                #(most common number,its frequency)
-                #Thus c.most_common(1)[0][1] is the frequency
-                #of the most common number.
-                if c.most_common(1)[0][1]>=4:
+                #max_run(roll) is the frequency of the most
+                #common number, since roll is sorted.
+                if max_run(roll)>=4:
                     if combo=='four of a kind':
                         points_dict[roll]=1.
                     else:
@@ -161,7 +156,6 @@ class Widget:
             
         elif combo=='full house' or combo=='full house weighted':
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
                 #For an arbitary number of dice, I define a full
                 #house to be only two different numbers appearing
                 #in the roll, and n_dice/2 of each for n_dice even,
@@ -170,26 +164,20 @@ class Widget:
                 #
                 #To treat both cases at the same time, let
                 #
-                #freq1=c.most_common(2)[0][1]
-                #freq2=c.most_common(2)[1][1]
+                #runs=run_lengths(roll)
                 #
-                #i.e. freq1 and freq2 are the frequencies of the
-                #two most common numbers.  For a full house, must
-                #have freq1+freq2=n_dice, and freq1, freq2 >= n_dice/2
-                #(integer division).
+                #i.e. the frequencies of the different numbers in
+                #the roll.  For a full house, must have exactly two
+                #runs (which then add up to n_dice), each of length
+                #>= n_dice/2 (integer division).
                 #
                 #The case of n_dice=1 must be treated separately;
                 #for that case, everything is a full house.
                 if self.n_dice==1:
                     points_dict[roll]=1.
                 else:
-                    mc=c.most_common(2)
-                    freq1=mc[0][1]
-                    if len(mc)<2:
-                        freq2=0
-                    else:
-                        freq2=mc[1][1]
-                    if freq1+freq2==self.n_dice and freq1>=self.n_dice/2 and freq2>=self.n_dice/2:
+                    runs=run_lengths(roll)
+                    if len(runs)==2 and min(runs)>=self.n_dice/2:
                         points_dict[roll]=1.
                     else:
                         points_dict[roll]=0.
@@ -198,70 +186,41 @@ class Widget:
                     points_dict[roll]*=25.  #25 is the point value of any full house
 
         elif combo=='small straight' or combo=='small straight weighted':
+            #A small straight means that n_dice-1 of the
+            #numbers on the dice are in consecutive order,
+            #and the remaining die can show any number.
+            #Encode the distinct numbers in the roll as a bit
+            #mask (bit v-1 set if v appears, see face_mask),
+            #then a small straight is a roll whose mask contains
+            #all the bits of one of the masks in small_straights,
+            #i.e. n_dice-1 consecutive bits starting at any
+            #number from 1 to n_faces-n_dice+2.
+            #
+            #n_dice<=2 needs no special treatment; then
+            #n_dice-1 consecutive numbers is at most a single
+            #number, which every roll contains.
+            run_mask=(1<<max(self.n_dice-1,0))-1
+            small_straights=[run_mask<<shift for shift in range(self.n_faces-self.n_dice+2)]
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
-                #A small straight means that n_dice-1 of the
-                #numbers on the dice are in consecutive order,
-                #and the remaining die can show any number.
-                #We can split this into two cases:
-                #(i) the remaining die shows a number different
-                #than any of the other dice.
-                #(ii) the remaining die shows a number the
-                #same as one of the other dice.
-                #Thus we have (i) all dice show different values
-                #and (ii) two dice show the same values but all
-                #the rest are different.  Therefore, we can look at
-                #
-                #freq1=c.most_common(2)[0][1]
-                #freq2=c.most_common(2)[1][1]
-                #
-                #which are the frequencies of the most and second
-                #most common number.  If freq1>2 then we definitely
-                #can't have a small straight.  If freq1=2 and freq2=2,
-                #then this is not a small straight either.  If freq1=2,
-                #and freq2=1, then we can use the fact that roll is
-                #sorted and test for case (ii) by checking if
-                #roll[-1]-roll[0]=n_dice-2.  
-                #If freq1=1 then all dice show different values, and
-                #we can check for case(i) by checking if
-                #roll[-2]-roll[0]=n_dice-2 or roll[-1]-roll[1]=n_dice-2.
-                #
-                #n_dice<=2 must be treated separately; in this case
-                #everything is a small straight.
-                if self.n_dice<=2:
-                    points_dict[roll]=1.
-                else:
-                    mc=c.most_common(2)
-                    freq1=mc[0][1]
-                    if len(mc)<2:
-                        freq2=0
-                    else:
-                        freq2=mc[1][1]
-                    if freq1>2:
-                        points_dict[roll]=0.
-                    elif freq1==2:
-                        if freq2==1 and roll[-1]-roll[0]==self.n_dice-2:
-                            points_dict[roll]=1.
-                        else:
-                            points_dict[roll]=0.
-                    else:
-                        if roll[-2]-roll[0]==self.n_dice-2 or roll[-1]-roll[1]==self.n_dice-2:
-                            points_dict[roll]=1.
-                        else:
-                            points_dict[roll]=0.
-                
+                mask=face_mask(roll)
+                points_dict[roll]=0.
+                for straight in small_straights:
+                    if mask&straight==straight:
+                        points_dict[roll]=1.
+                        break
+
                 if combo=='small straight weighted':
                     points_dict[roll]*=30.  #30 is the point value of any small straight
 
         elif combo=='large straight' or combo=='large straight weighted':
+            run_mask=(1<<self.n_dice)-1
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
                 #A large straight is when all dice show numbers
                 #in consecutive order.  Since roll is sorted, can
-                #test for this by checking that all numbers in
-                #the roll are different (c.most_common(1)[0][1]=1),
-                #and that roll[-1]-roll[0]=n_dice-1.
-                if c.most_common(1)[0][1]==1 and roll[-1]-roll[0]==self.n_dice-1:
+                #test for this by checking that the distinct numbers
+                #in the roll (face_mask) are exactly the n_dice
+                #consecutive numbers starting at roll[0].
+                if face_mask(roll)==run_mask<<(roll[0]-1):
                     points_dict[roll]=1.
                 else:
                     points_dict[roll]=0.
@@ -271,8 +230,9 @@ class Widget:
 
         elif combo=='yahtzee' or combo=='yahtzee weighted':
             for roll in rolls(self.n_dice,self.n_faces):
-                c=Counter(roll)
-                if c.most_common(1)[0][1]==self.n_dice:
+                #roll is sorted, so all dice are the same
+                #exactly when the first and last are.
+                if roll[0]==roll[-1]:
                     points_dict[roll]=1.
                 else:
                     points_dict[roll]=0.
@@ -469,7 +429,7 @@ class Widget:
         tot=0
         denom=0
         for rolled in rolls(self.n_dice-n_kept,self.n_faces):
-            roll=tuple(sort(kept+rolled))
+            roll=merge_sorted(kept,rolled)
             mult=multiplicity(rolled)
             #Note that it's the probability of getting the values
             #in 'rolled' that we care about, since we have already
@@ -571,6 +531,66 @@ def multiplicity(roll):
     c=Counter(roll)
     return factorial(len(roll))/product([factorial(n) for n in c.values()])
 
+def run_lengths(roll):
+    """
+    Returns a list of the lengths of the runs of equal
+    values in roll, i.e. the frequency of each number
+    appearing in roll.  Since roll is sorted, equal values
+    are adjacent, so this is a single scan with no Counter.
+    For example run_lengths((1,1,3,3,3))=[2,3].
+    """
+    runs=[]
+    for i in range(len(roll)):
+        if i>0 and roll[i]==roll[i-1]:
+            runs[-1]+=1
+        else:
+            runs.append(1)
+    return runs
+
+def max_run(roll):
+    """
+    Returns the length of the longest run of equal
+    values in roll, i.e. the frequency of the most
+    common number.  Assumes roll is sorted.
+    """
+    best=0
+    run=0
+    for i in range(len(roll)):
+        if i>0 and roll[i]==roll[i-1]:
+            run+=1
+        else:
+            run=1
+        if run>best:
+            best=run
+    return best
+
+def face_mask(roll):
+    """
+    Returns an integer bit mask of the distinct numbers
+    in roll, with bit v-1 set if the number v appears.
+    For example face_mask((1,1,3,4))=0b1101.
+    """
+    mask=0
+    for d in roll:
+        mask|=1<<(d-1)
+    return mask
+
+def merge_sorted(sr,roll):
+    """
+    Returns the sorted tuple containing the dice of both
+    sr and roll, which must both be sorted.  Each die of
+    sr is inserted at its place in roll using bisect,
+    rather than sorting the combined roll from scratch.
+    For example merge_sorted((2,5),(1,2,6))=(1,2,2,5,6).
+    """
+    merged=list(roll)
+    lo=0
+    for d in sr:
+        lo=bisect_right(merged,d,lo)
+        merged.insert(lo,d)
+        lo+=1
+    return tuple(merged)
+
 def subroll(sr,roll):
     """
     Returns True if sr is a subroll of roll, and False
@@ -668,3 +688,44 @@ if __name__ == "__main__":
     assert(sorted(w.strategy[1][(1,2,3,5,6)])==sorted([(),(1,),(2,),(3,),(5,),(6,)]))
     assert(sorted(w.strategy[0][(1,2,3,4,5)])==sorted([(),(1,),(2,),(3,),(4,),(5,)]))
     assert(sorted(w.strategy[0][(1,2,3,5,6)])==sorted([(),(1,),(2,),(3,),(5,),(6,)]))
+
+    #THREE AND FOUR OF A KIND
+    w=Widget('three of a kind')
+    assert(w.values[2][(2,2,2,5,6)]==1.0)
+    assert(w.values[2][(1,4,4,4,4)]==1.0)
+    assert(w.values[2][(3,3,3,3,3)]==1.0)
+    assert(w.values[2][(1,1,2,2,6)]==0.0)
+    assert(w.values[2][(1,2,3,4,5)]==0.0)
+    w=Widget('four of a kind')
+    assert(w.values[2][(1,5,5,5,5)]==1.0)
+    assert(w.values[2][(6,6,6,6,6)]==1.0)
+    assert(w.values[2][(2,2,2,5,5)]==0.0)
+    assert(w.values[2][(1,1,1,4,6)]==0.0)
+
+    #FULL HOUSE
+    w=Widget('full house')
+    assert(w.values[2][(2,2,2,5,5)]==1.0)
+    assert(w.values[2][(1,1,6,6,6)]==1.0)
+    assert(w.values[2][(3,3,3,3,4)]==0.0)
+    assert(w.values[2][(4,4,4,4,4)]==0.0)
+    assert(w.values[2][(1,1,2,2,3)]==0.0)
+    w=Widget('full house',n_dice=4)
+    assert(w.values[2][(1,1,6,6)]==1.0)
+    assert(w.values[2][(1,6,6,6)]==0.0)
+
+    #SMALL AND LARGE STRAIGHT
+    w=Widget('small straight')
+    assert(w.values[2][(1,2,3,4,6)]==1.0)
+    assert(w.values[2][(2,3,3,4,5)]==1.0)
+    assert(w.values[2][(1,3,4,5,6)]==1.0)
+    assert(w.values[2][(2,3,4,5,6)]==1.0)
+    assert(w.values[2][(1,2,3,5,6)]==0.0)
+    assert(w.values[2][(1,1,2,2,3)]==0.0)
+    w=Widget('large straight')
+    assert(w.values[2][(1,2,3,4,5)]==1.0)
+    assert(w.values[2][(2,3,4,5,6)]==1.0)
+    assert(w.values[2][(1,2,3,4,6)]==0.0)
+    assert(w.values[2][(2,3,3,4,5)]==0.0)
+    w=Widget('large straight weighted',n_dice=3)
+    assert(w.values[2][(4,5,6)]==40.0)
+    assert(w.values[2][(4,5,5)]==0.0)